@@ -15,11 +15,18 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import torch
+import numpy as np
 import math
+import io
+import os
+import functools
+import concurrent.futures
 from transformers import set_seed as transformers_set_seed
 from transformers import get_scheduler as transformers_get_scheduler
 from transformers import Trainer
+from transformers.trainer import OPTIMIZER_NAME, SCHEDULER_NAME
 from transformers.trainer_utils import seed_worker as trainer_utils_seed_worker
+from torch.utils._pytree import tree_map
 from tqdm import tqdm as ProgressBar
 from packaging.version import Version
 from transformers.models.llama.modeling_llama import logger
@@ -28,6 +35,8 @@ import time
 __all__ = [
     "fix_zero_training_loss",
     "unsloth_train",
+    "save_checkpoint",
+    "load_checkpoint",
 ]
 
 
@@ -42,15 +51,43 @@ def fix_zero_training_loss(model, tokenizer, train_dataset):
     row = train_dataset[0]
     if type(row) is dict and "labels" in row:
 
-        # Check the first 100 rows
-        seen_bad  = 0
-        seen_good = 0
-        for i, row in enumerate(train_dataset):
-            try:    check_tokens = list(set(row["labels"]))
-            except: continue
-            if len(check_tokens) == 1 and check_tokens[0] == -100: seen_bad += 1
-            else: seen_good += 1
-            if i >= 100: break
+        # Check the first 100 rows with one vectorized reduction
+        seen_bad = seen_good = None
+        try:
+            rows = train_dataset[:101]["labels"]
+            if not torch.is_tensor(rows):
+                try:
+                    rows = torch.as_tensor(rows)
+                except (ValueError, TypeError):
+                    # Ragged rows - pad with -100 so padding never counts as good
+                    rows = torch.nn.utils.rnn.pad_sequence(
+                        [torch.as_tensor(x) for x in rows],
+                        batch_first = True,
+                        padding_value = -100,
+                    )
+                pass
+            pass
+            good = (rows != -100).any(dim = -1)
+            seen_good = int(good.sum())
+            seen_bad  = int(good.numel()) - seen_good
+        except:
+            pass
+        pass
+
+        if seen_bad is None:
+            # Datasets that cannot be sliced column-wise (eg map-style torch
+            # datasets) fall back to the row-by-row walk, skipping only the
+            # rows that fail
+            seen_bad  = 0
+            seen_good = 0
+            for i, row in enumerate(train_dataset):
+                try:    check_tokens = list(set(row["labels"]))
+                except: continue
+                if len(check_tokens) == 1 and check_tokens[0] == -100: seen_bad += 1
+                else: seen_good += 1
+                if i >= 100: break
+            pass
+            if seen_bad + seen_good == 0: return
         pass
 
         # Check ratio
@@ -65,6 +102,111 @@ def fix_zero_training_loss(model, tokenizer, train_dataset):
 pass
 
 
+# Background checkpoint writer. Serialization is slow (disk I/O), so we stage
+# state dicts to pinned CPU memory (fast D2H) then hand the torch.save to a
+# single worker thread while training continues.
+_CHECKPOINT_EXECUTOR = None
+_pending_checkpoints = []
+
+def _get_checkpoint_executor():
+    global _CHECKPOINT_EXECUTOR
+    if _CHECKPOINT_EXECUTOR is None:
+        _CHECKPOINT_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+    return _CHECKPOINT_EXECUTOR
+pass
+
+
+def _wait_for_pending_checkpoints():
+    # Block until prior background saves finish so writes never overlap
+    for future in _pending_checkpoints: future.result()
+    _pending_checkpoints.clear()
+pass
+
+
+def _stage_state_dict_to_cpu(state_dict, copy_stream):
+    # Copy all CUDA tensors into pinned CPU buffers on a side stream so the
+    # background thread never touches GPU memory
+    def _stage(x):
+        if torch.is_tensor(x) and x.is_cuda:
+            staged = torch.empty_like(x, device = "cpu", pin_memory = True)
+            staged.copy_(x, non_blocking = True)
+            return staged
+        return x
+    pass
+    # The optimizer step that produced these tensors may still be running
+    # on the current stream - order the staging copies after it
+    copy_stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(copy_stream):
+        staged_state_dict = tree_map(_stage, state_dict)
+    copy_stream.synchronize()
+    return staged_state_dict
+pass
+
+
+def _torch_save_bulk(payload, path):
+    # Pickle into memory first, then write once - torch.save straight to disk
+    # interleaves pickling with thousands of small blocking write() syscalls
+    # Only ever serialize plain state dicts - pickling the Optimizer object
+    # itself drags in parameter references and autograd state
+    assert isinstance(payload, dict)
+    buffer = io.BytesIO()
+    torch.save(payload, buffer)
+    with open(path, "wb") as file:
+        file.write(buffer.getbuffer())
+pass
+
+
+def _write_checkpoint(optimizer_state, scheduler_state, output_dir):
+    _torch_save_bulk(optimizer_state, os.path.join(output_dir, OPTIMIZER_NAME))
+    _torch_save_bulk(scheduler_state, os.path.join(output_dir, SCHEDULER_NAME))
+pass
+
+
+def load_checkpoint(optimizer, lr_scheduler, checkpoint_dir):
+    """
+    Restores optimizer and scheduler states saved by save_checkpoint.
+    Loads onto CPU with weights_only = True since the files only ever
+    contain plain state dicts.
+    """
+    optimizer.load_state_dict(torch.load(
+        os.path.join(checkpoint_dir, OPTIMIZER_NAME),
+        map_location = "cpu", weights_only = True,
+    ))
+    lr_scheduler.load_state_dict(torch.load(
+        os.path.join(checkpoint_dir, SCHEDULER_NAME),
+        map_location = "cpu", weights_only = True,
+    ))
+pass
+
+
+def save_checkpoint(trainer, optimizer, lr_scheduler, step, async_save = True):
+    """
+    Saves the model, optimizer and scheduler states for the current step.
+    With async_save, state dicts are staged to pinned CPU memory, then
+    serialized in a background thread so the training loop is not blocked
+    by disk I/O.
+    """
+    output_dir = os.path.join(trainer.args.output_dir, f"checkpoint-{step}")
+    os.makedirs(output_dir, exist_ok = True)
+    trainer.save_model(output_dir)
+
+    optimizer_state = optimizer.state_dict()
+    scheduler_state = lr_scheduler.state_dict()
+
+    if async_save and torch.cuda.is_available():
+        copy_stream = torch.cuda.Stream()
+        optimizer_state = _stage_state_dict_to_cpu(optimizer_state, copy_stream)
+        scheduler_state = _stage_state_dict_to_cpu(scheduler_state, copy_stream)
+        _wait_for_pending_checkpoints()
+        _pending_checkpoints.append(_get_checkpoint_executor().submit(
+            _write_checkpoint, optimizer_state, scheduler_state, output_dir,
+        ))
+    else:
+        _write_checkpoint(optimizer_state, scheduler_state, output_dir)
+    pass
+pass
+
+
 def get_max_steps(training_args, n_training_samples, train_dataset):
     # Approximately from https://github.com/huggingface/transformers/blob/main/src/transformers/trainer.py#L2092
     # Determines batch size, max steps, ga etc
@@ -95,22 +237,317 @@ pass
 
 
 def set_training(model):
-    # Start training
+    # Start training - .train() propagates to all submodules in one
+    # traversal and also flips dropout / batchnorm state correctly
+    if isinstance(model, torch.nn.Module):
+        model.train(True)
+        return
+    pass
+    # Non nn.Module wrappers only expose nested .model attributes
     model.training = True
     while hasattr(model, "model"):
         model = model.model
         model.training = True
-    model.training = True
+    pass
 pass
 
 
 def unset_training(model):
     # End training
+    if isinstance(model, torch.nn.Module):
+        model.train(False)
+        return
+    pass
     model.training = False
     while hasattr(model, "model"):
         model = model.model
         model.training = False
-    model.training = False
+    pass
+pass
+
+
+class _InBackwardOptimizer:
+    """
+    Runs the optimizer update of each parameter inside backward, as soon
+    as its gradient for the final micro-batch of the accumulation window
+    lands - the update of layer L overlaps the backward of earlier layers
+    instead of waiting for one monolithic step afterwards.
+
+    One single-parameter optimizer is built per parameter so the hooks can
+    step independently. Gradient accumulation is handled by arming the
+    hooks only during the last micro-batch of each window. Global grad
+    norm clipping cannot run before the updates in this mode, so it is
+    skipped. state_dict/load_state_dict aggregate over all the
+    per-parameter optimizers for checkpointing.
+    """
+    def __init__(self, optimizer_cls, optimizer_kwargs, parameter_groups):
+        self.armed      = False
+        self.optimizers = []
+        self.hooks      = []
+        for group in parameter_groups:
+            for param in group["params"]:
+                kwargs = {**optimizer_kwargs, "weight_decay" : group["weight_decay"]}
+                optimizer = optimizer_cls([param], **kwargs)
+                self.optimizers.append(optimizer)
+                self.hooks.append(param.register_post_accumulate_grad_hook(
+                    functools.partial(self._step_param, optimizer = optimizer)
+                ))
+            pass
+        pass
+    pass
+
+    def _step_param(self, param, optimizer):
+        if not self.armed: return
+        optimizer.step()
+        optimizer.zero_grad(set_to_none = True)
+    pass
+
+    def arm(self):    self.armed = True
+    pass
+    def disarm(self): self.armed = False
+    pass
+
+    def broadcast_lr(self):
+        # The lr scheduler only drives the first optimizer - fan its lr out
+        lr = self.optimizers[0].param_groups[0]["lr"]
+        for optimizer in self.optimizers[1:]:
+            optimizer.param_groups[0]["lr"] = lr
+    pass
+
+    def state_dict(self):
+        return {"optimizers" : [optimizer.state_dict() for optimizer in self.optimizers]}
+    pass
+
+    def load_state_dict(self, state_dict):
+        for optimizer, state in zip(self.optimizers, state_dict["optimizers"]):
+            optimizer.load_state_dict(state)
+    pass
+
+    def detach(self):
+        # Remove the hooks and drop the per-parameter optimizers - each
+        # closure otherwise pins a full set of exp_avg/exp_avg_sq state on
+        # the model for the lifetime of the parameter
+        for hook in self.hooks: hook.remove()
+        self.hooks.clear()
+        self.optimizers.clear()
+    pass
+pass
+
+
+class _BF16GradientAccumulator:
+    """
+    Accumulates gradients across micro-batches into bfloat16 buffers via
+    post-accumulate-grad hooks, halving gradient memory traffic during
+    backward. FP32 .grad is materialized again right before clipping and
+    the optimizer step, so optimizer math stays in full precision.
+    """
+    def __init__(self, parameters):
+        self.parameters = parameters
+        self.buffers = [torch.zeros_like(param, dtype = torch.bfloat16) for param in parameters]
+        self.hooks = [
+            param.register_post_accumulate_grad_hook(
+                functools.partial(self._accumulate, buffer = buffer)
+            )
+            for param, buffer in zip(parameters, self.buffers)
+        ]
+    pass
+
+    @staticmethod
+    def _accumulate(param, buffer):
+        # Fold the fresh fp32 gradient into the bf16 buffer and free it
+        buffer.add_(param.grad.to(torch.bfloat16))
+        param.grad = None
+    pass
+
+    def restore_gradients(self):
+        for param, buffer in zip(self.parameters, self.buffers):
+            param.grad = buffer.to(torch.float32)
+            buffer.zero_()
+    pass
+
+    def detach(self):
+        # Remove the hooks so later backwards on the same model accumulate
+        # normally instead of feeding these buffers
+        for hook in self.hooks: hook.remove()
+        self.hooks.clear()
+    pass
+pass
+
+
+class _PreShuffledSampler(torch.utils.data.Sampler):
+    """
+    Yields a permutation precomputed with numpy's PCG64 - one vectorized
+    shuffle per epoch instead of RandomSampler's per-index RNG draws.
+    set_epoch reseeds so every epoch gets a fresh, reproducible order.
+    """
+    def __init__(self, n_samples, seed):
+        self.n_samples = n_samples
+        self.seed      = seed
+        self.epoch     = 0
+    pass
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+    pass
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        return iter(rng.permutation(self.n_samples).tolist())
+    pass
+
+    def __len__(self):
+        return self.n_samples
+    pass
+pass
+
+
+class _LengthBucketedBatchSampler(torch.utils.data.Sampler):
+    """
+    Batches rows of similar length together so padding only bridges the
+    gap inside a bucket, not between the shortest and longest sample the
+    shuffle happens to mix - compute goes to real tokens, not pad tokens.
+    Rows are shuffled, stably sorted by bucketed length, cut into batches,
+    and the batch order is shuffled again so short batches do not cluster
+    at the start of the epoch.
+    """
+    def __init__(self, lengths, batch_size, seed, bucket_width = 128, drop_last = False):
+        self.lengths      = np.asarray(lengths, dtype = np.int32)
+        self.batch_size   = batch_size
+        self.seed         = seed
+        self.bucket_width = bucket_width
+        self.drop_last    = drop_last
+        self.epoch        = 0
+    pass
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+    pass
+
+    def __iter__(self):
+        rng  = np.random.default_rng(self.seed + self.epoch)
+        perm = rng.permutation(len(self.lengths))
+        # Stable sort by bucket keeps the shuffle order within each bucket
+        order = perm[np.argsort(self.lengths[perm] // self.bucket_width, kind = "stable")]
+        batches = [
+            order[i : i + self.batch_size]
+            for i in range(0, len(order), self.batch_size)
+        ]
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        pass
+        for i in rng.permutation(len(batches)):
+            yield batches[i].tolist()
+    pass
+
+    def __len__(self):
+        if self.drop_last: return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+    pass
+pass
+
+
+class _CUDAGraphedOptimizerStep:
+    """
+    Captures grad clipping + optimizer.step() + gradient zeroing into one
+    CUDA graph after a few eager warmup steps, so the whole optimizer tail
+    replays as a single cudaGraphLaunch instead of hundreds of tiny
+    per-parameter kernels.
+
+    The caller must keep gradient storage stable across steps (we zero in
+    place rather than set_to_none) and use a capturable optimizer. Learning
+    rates are re-routed through persistent CUDA tensors so lr_scheduler
+    updates still land on every replay.
+    """
+    NUM_WARMUP_STEPS = 3
+
+    def __init__(self, optimizer, parameters, max_grad_norm):
+        self.optimizer     = optimizer
+        self.parameters    = parameters
+        self.max_grad_norm = max_grad_norm
+        self.graph         = None
+        self.steps_seen    = 0
+        # The captured kernels read these tensors on every replay
+        self.lr_tensors = []
+        for group in optimizer.param_groups:
+            lr_tensor = torch.full((), group["lr"], device = "cuda:0", dtype = torch.float32)
+            group["lr"] = lr_tensor
+            if "capturable" in group: group["capturable"] = True
+            self.lr_tensors.append(lr_tensor)
+        pass
+    pass
+
+    def sync_lr(self):
+        # lr_scheduler.step() overwrites group["lr"] with a Python float -
+        # copy it into the persistent tensor and put the tensor back
+        for group, lr_tensor in zip(self.optimizer.param_groups, self.lr_tensors):
+            if not torch.is_tensor(group["lr"]):
+                lr_tensor.fill_(group["lr"])
+                group["lr"] = lr_tensor
+            pass
+        pass
+    pass
+
+    def _eager_step(self):
+        torch.nn.utils.clip_grad_norm_(self.parameters, self.max_grad_norm, foreach = True)
+        self.optimizer.step()
+        torch._foreach_zero_([
+            param.grad for param in self.parameters if param.grad is not None
+        ])
+    pass
+
+    def step(self):
+        if self.graph is not None:
+            self.graph.replay()
+            return
+        pass
+        self.steps_seen += 1
+        if self.steps_seen <= self.NUM_WARMUP_STEPS:
+            # Warmup in eager mode so allocator / optimizer state settles
+            self._eager_step()
+            return
+        pass
+        torch.cuda.synchronize()
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self._eager_step()
+        pass
+        # Capture only records the work - replay so this window's
+        # clip/step/zero actually execute
+        self.graph.replay()
+    pass
+pass
+
+
+class _GraphableForward(torch.nn.Module):
+    # make_graphed_callables needs a callable that takes and returns plain
+    # tensors, so unwrap the HF output down to the loss
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+    pass
+
+    def forward(self, input_ids, labels, n_items):
+        return self.model(input_ids = input_ids, labels = labels, n_items = n_items).loss
+    pass
+pass
+
+
+def _gradient_accumulation_schedule(step, max_steps, ga_start, ga_end):
+    # Linear batch size ramp: a small accumulation window early in training
+    # gives more optimizer updates per token, growing to the full window
+    if step >= max_steps: return ga_end
+    ga = ga_start + (ga_end - ga_start) * step / max(max_steps - 1, 1)
+    return max(1, int(round(ga)))
+pass
+
+
+def _prefetch_to_cuda(batch, copy_stream):
+    # Enqueue the H2D copies on a side stream so they overlap the previous
+    # micro-batch's compute. Relies on the DataLoader pinning the batch.
+    with torch.cuda.stream(copy_stream):
+        input_ids = batch["input_ids"].to(device = "cuda:0", non_blocking = True)
+        labels    = batch["labels"]   .to(device = "cuda:0", non_blocking = True)
+    return input_ids, labels
 pass
 
 
@@ -150,14 +587,16 @@ def unsloth_train(trainer):
 
     # Separate weight decay for parameters
     optimizer_cls, optimizer_kwargs = Trainer.get_optimizer_cls_and_kwargs(training_args)
-    decay_parameters = frozenset(Trainer.get_decay_parameter_names(None, model))
-    yes_decay, no_decay = [], []
-    n_parameters_to_train = 0
-    for name, param in model.named_parameters():
-        if not param.requires_grad: continue
-        if name in decay_parameters: yes_decay.append(param)
-        else: no_decay.append(param)
-        n_parameters_to_train += param.numel()
+    if hasattr(model, "_unsloth_param_groups"):
+        # Re-runs on the same model skip the named_parameters walk entirely
+        yes_decay, no_decay, n_parameters_to_train = model._unsloth_param_groups
+    else:
+        decay_parameters = frozenset(Trainer.get_decay_parameter_names(None, model))
+        trainable = [(name, param) for name, param in model.named_parameters() if param.requires_grad]
+        yes_decay = [param for name, param in trainable if name     in decay_parameters]
+        no_decay  = [param for name, param in trainable if name not in decay_parameters]
+        n_parameters_to_train = sum(param.numel() for name, param in trainable)
+        model._unsloth_param_groups = (yes_decay, no_decay, n_parameters_to_train,)
     pass
     optimizer_grouped_parameters = [
         {"params" : yes_decay, "weight_decay" : training_args.weight_decay,},
@@ -166,7 +605,21 @@ def unsloth_train(trainer):
     trainable_parameters = \
         optimizer_grouped_parameters[0]["params"] + \
         optimizer_grouped_parameters[1]["params"]
-    optimizer = optimizer_cls(optimizer_grouped_parameters, **optimizer_kwargs)
+
+    # Optionally fuse the optimizer update into backward. Not usable with
+    # the fp16 GradScaler, which must unscale before any update.
+    optimizer_in_backward = None
+    if getattr(training_args, "optimizer_in_backward", False) \
+            and model.config.torch_dtype != torch.float16:
+        optimizer_in_backward = _InBackwardOptimizer(
+            optimizer_cls, optimizer_kwargs, optimizer_grouped_parameters,
+        )
+        # The lr scheduler drives the first per-parameter optimizer; its lr
+        # is broadcast to the rest every step
+        optimizer = optimizer_in_backward.optimizers[0]
+    else:
+        optimizer = optimizer_cls(optimizer_grouped_parameters, **optimizer_kwargs)
+    pass
 
     total_train_batch_size, max_steps, num_train_epochs, num_train_samples = \
         get_max_steps(training_args, n_training_samples, trainer.train_dataset)
@@ -179,15 +632,30 @@ def unsloth_train(trainer):
         num_training_steps = max_steps,
         **getattr(training_args, "lr_scheduler_kwargs", {}),
     )
+    # The scheduler only initialized the first per-parameter optimizer's
+    # warmup lr - fan it out before the first window's hooks fire, or the
+    # others would step at the raw full lr
+    if optimizer_in_backward is not None:
+        optimizer_in_backward.broadcast_lr()
+    pass
 
-    # Gradient accumulation and grad norm clipping
+    # Gradient accumulation and grad norm clipping. foreach uses the
+    # horizontally fused multi-tensor kernels - one launch for the norm and
+    # one for the scale instead of one per parameter
     max_grad_norm   = training_args.max_grad_norm
-    clip_grad_norm_ = torch.nn.utils.clip_grad_norm_
+    clip_grad_norm_ = functools.partial(torch.nn.utils.clip_grad_norm_, foreach = True)
     gradient_accumulation_steps = training_args.gradient_accumulation_steps
+    # Plain Python float - scalars broadcast into CUDA kernels without a
+    # materialized GPU tensor or a blocking H2D at setup
     inverse_gradient_accumulation_steps = 1.0 / gradient_accumulation_steps
-    inverse_gradient_accumulation_steps = \
-        torch.FloatTensor([inverse_gradient_accumulation_steps])\
-        .to(device = "cuda:0", non_blocking = True)[0]
+
+    # Optional linear ramp of the accumulation window (effective batch size
+    # ramp). The loss is already normalized by n_items, the number of
+    # supervised tokens in the window, so no 1/ga rescale is needed.
+    ga_ramp_start = getattr(training_args, "gradient_accumulation_ramp_start", None)
+    if ga_ramp_start is not None:
+        ga_ramp_start = min(max(int(ga_ramp_start), 1), gradient_accumulation_steps)
+    pass
 
     # Mixed precision scaling
     if model.config.torch_dtype == torch.float16:
@@ -200,7 +668,28 @@ def unsloth_train(trainer):
         float16_scaler = None
     pass
     
-    optimizer.zero_grad()
+    # Optionally capture the optimizer tail into a CUDA graph. Needs stable
+    # gradient storage and a capturable optimizer, so it is incompatible
+    # with the fp16 GradScaler and with bf16 gradient accumulation (both
+    # re-allocate .grad between steps)
+    cuda_graph_step = None
+    if getattr(training_args, "cuda_graph_optimizer_step", False) \
+            and float16_scaler is None \
+            and optimizer_in_backward is None \
+            and not getattr(training_args, "bf16_grad_accum", False):
+        cuda_graph_step = _CUDAGraphedOptimizerStep(optimizer, trainable_parameters, max_grad_norm)
+    pass
+
+    # Optionally accumulate gradients across micro-batches in bf16
+    bf16_gradient_accumulator = None
+    if mixed_precision == "bf16" and optimizer_in_backward is None \
+            and getattr(training_args, "bf16_grad_accum", False):
+        bf16_gradient_accumulator = _BF16GradientAccumulator(trainable_parameters)
+    pass
+
+    # set_to_none frees gradient buffers instead of memsetting them -
+    # skips a full-parameter write of zeros every step
+    optimizer.zero_grad(set_to_none = True)
 
     # torch.cuda.amp.autocast is deprecated >= 2.4
     torch_version = torch.__version__
@@ -217,6 +706,20 @@ def unsloth_train(trainer):
         )
     pass
 
+    # Checkpointing every save_steps if requested
+    save_steps = training_args.save_steps \
+        if getattr(training_args, "save_strategy", "no") == "steps" else 0
+    async_save = getattr(training_args, "async_save", True)
+
+    # Side stream for double buffered H2D prefetching of micro-batches
+    copy_stream = torch.cuda.Stream()
+
+    # Loss logging reads the value one logging step late via an async D2H
+    # copy into pinned memory - .cpu().item() every time would hard sync
+    loss_cpu_buffer   = torch.empty(1, dtype = torch.float32, pin_memory = True)
+    loss_copy_event   = torch.cuda.Event()
+    pending_loss_step = None
+
     step = 0
     accumulated_loss = torch.zeros(1, device = "cuda:0", dtype = torch.float32)[0]
     max_iterations   = int(math.ceil(n_training_samples / gradient_accumulation_steps))
@@ -231,70 +734,253 @@ def unsloth_train(trainer):
         f' "-____-"     Number of trainable parameters = {n_parameters_to_train:,}'
     logger.warning(debug_info)
 
+    # Optionally CUDA-graph the whole forward+backward. Shapes must be
+    # static, so the graph is captured from the first batch; batches with a
+    # different padded shape fall back to eager. Mutually exclusive with
+    # the other paths that touch loss scaling or .grad storage.
+    use_graphed_forward = getattr(training_args, "cuda_graph_forward", False) \
+        and float16_scaler is None \
+        and bf16_gradient_accumulator is None \
+        and optimizer_in_backward is None \
+        and not getattr(training_args, "torch_compile", False)
+    graphed_forward = None
+    graphed_shape   = None
+
+    # Optionally compile the forward. The micro-batch size is constant for
+    # the whole run and the collator pads to a multiple, so shapes
+    # specialize and reduce-overhead mode can replay CUDA graphs.
+    forward_model = model
+    if getattr(training_args, "torch_compile", False):
+        forward_model = torch.compile(
+            model,
+            mode      = "reduce-overhead",
+            fullgraph = False,
+            dynamic   = False,
+        )
+    pass
+
+    # One DataLoader for the whole run - the samplers reshuffle themselves
+    # per epoch via set_epoch, and persistent workers skip the fork +
+    # tokenizer reload that tearing the loader down each epoch would cost
+    dataloader_kwargs = {}
+    if training_args.dataloader_num_workers > 0:
+        dataloader_kwargs["persistent_workers"] = True
+        dataloader_kwargs["prefetch_factor"]    = max(4, gradient_accumulation_steps)
+    pass
+    if getattr(training_args, "group_by_length", False):
+        # Bucket rows of similar length into the same batch to cut padding
+        lengths = np.fromiter(
+            (len(row["input_ids"]) for row in trainer.train_dataset),
+            dtype = np.int32,
+            count = n_training_samples,
+        )
+        train_sampler = _LengthBucketedBatchSampler(
+            lengths,
+            training_args.per_device_train_batch_size,
+            training_args.seed,
+            drop_last = training_args.dataloader_drop_last,
+        )
+        batching_kwargs = {"batch_sampler" : train_sampler}
+    else:
+        train_sampler = _PreShuffledSampler(n_training_samples, training_args.seed)
+        batching_kwargs = {
+            "batch_size" : training_args.per_device_train_batch_size,
+            "sampler"    : train_sampler,
+            "drop_last"  : training_args.dataloader_drop_last,
+        }
+    pass
+    train_dataloader = torch.utils.data.DataLoader(
+        trainer.train_dataset,
+        num_workers    = training_args.dataloader_num_workers,
+        collate_fn     = data_collator,
+        pin_memory     = training_args.dataloader_pin_memory,
+        worker_init_fn = trainer_utils_seed_worker,
+        **batching_kwargs,
+        **dataloader_kwargs,
+    )
+
     progress_bar = ProgressBar(total = max_steps*num_train_epochs, dynamic_ncols = True)
     logging_steps = training_args.logging_steps
     # Go through each epoch
     start_time = time.time()
-    for epoch in range(num_train_epochs):
-
-        # We also need to shuffle the data loader every epoch!
-        transformers_set_seed(training_args.seed + epoch)
-        train_dataloader_iterator = iter(torch.utils.data.DataLoader(
-            trainer.train_dataset,
-            batch_size     = training_args.per_device_train_batch_size,
-            sampler        = torch.utils.data.RandomSampler(trainer.train_dataset),
-            num_workers    = training_args.dataloader_num_workers,
-            collate_fn     = data_collator,
-            pin_memory     = training_args.dataloader_pin_memory,
-            drop_last      = training_args.dataloader_drop_last,
-            worker_init_fn = trainer_utils_seed_worker,
-        ))
-
-        for j in range(max_iterations):
-            n_batches = leftover_batches if j == (max_iterations-1) else gradient_accumulation_steps
-            batches = [next(train_dataloader_iterator) for j in range(n_batches)]
+    try:
+        for epoch in range(num_train_epochs):
+
+            # Reshuffle through the sampler's own seed + epoch RNG. Reseeding
+            # every library via transformers_set_seed here would sync all CUDA
+            # devices and clobber the dropout RNG stream the model advanced.
+            train_sampler.set_epoch(epoch)
+            train_dataloader_iterator = iter(train_dataloader)
+
+            j = 0
+            while step < max_steps:
+                if ga_ramp_start is not None:
+                    n_batches = _gradient_accumulation_schedule(
+                        step, max_steps, ga_ramp_start, gradient_accumulation_steps,
+                    )
+                else:
+                    n_batches = leftover_batches if j == (max_iterations-1) else gradient_accumulation_steps
+                pass
+                # The dataloader can run out before the window fills
+                batches = []
+                for _ in range(n_batches):
+                    try: batches.append(next(train_dataloader_iterator))
+                    except StopIteration: break
+                pass
+                if len(batches) == 0: break
+                n_batches = len(batches)
                 
-            # Count non zeros before loss calc
-            n_items = torch.stack([
-                torch.count_nonzero(x["labels"][..., 1:] != -100) for x in batches
-            ]).sum()
-
-            # Gradient accumulation
-            for batch in batches:
-                input_ids = batch["input_ids"].pin_memory().to(device = "cuda:0", non_blocking = True)
-                labels    = batch["labels"]   .pin_memory().to(device = "cuda:0", non_blocking = True)
-
-                with autocast_context_manager:
-                    loss = model(input_ids = input_ids, labels = labels, n_items = n_items).loss
-                    # loss = loss * inverse_gradient_accumulation_steps
-                    accumulated_loss += loss.detach()
+                # Count non zeros before loss calc - one fused reduction instead
+                # of one count_nonzero launch per micro-batch
+                n_items = (torch.cat([
+                    x["labels"][..., 1:].reshape(-1) for x in batches
+                ]) != -100).sum()
+                # Graph replay reads n_items from a static device buffer, so it
+                # must be a CUDA tensor, not a CPU scalar baked into the graph
+                if use_graphed_forward:
+                    n_items = n_items.to(device = "cuda:0", non_blocking = True)
                 pass
 
-                if float16_scaler is None:  loss.backward()
-                else: float16_scaler.scale(loss).backward()
-            pass
+                # Gradient accumulation, horizontal schedule: each micro-batch
+                # runs forward+backward end to end. A vertical (layer-major)
+                # schedule would reuse each layer's weights across all
+                # micro-batches before moving on, but needs per-layer forward /
+                # backward control we cannot get through the generic HF
+                # model(...) call without breaking gradient checkpointing,
+                # attention mask construction and non-Llama architectures.
+                next_transfer = _prefetch_to_cuda(batches[0], copy_stream)
+                for i in range(n_batches):
+                    input_ids, labels = next_transfer
+                    # Compute must see the finished copy; then prefetch the next
+                    # micro-batch so its H2D overlaps this one's forward/backward
+                    torch.cuda.current_stream().wait_stream(copy_stream)
+                    input_ids.record_stream(torch.cuda.current_stream())
+                    labels   .record_stream(torch.cuda.current_stream())
+                    if i + 1 < n_batches:
+                        next_transfer = _prefetch_to_cuda(batches[i + 1], copy_stream)
+                    pass
+
+                    if use_graphed_forward and graphed_forward is None:
+                        # Capture on the first batch's shape. The warmup
+                        # backwards pollute .grad, so zero it in place after
+                        with autocast_context_manager:
+                            graphed_forward = torch.cuda.make_graphed_callables(
+                                _GraphableForward(model),
+                                (input_ids, labels, n_items,),
+                                num_warmup_iters = 3,
+                            )
+                        graphed_shape = input_ids.shape
+                        torch._foreach_zero_([
+                            param.grad for param in trainable_parameters if param.grad is not None
+                        ])
+                    pass
+
+                    with autocast_context_manager:
+                        if use_graphed_forward and input_ids.shape == graphed_shape:
+                            loss = graphed_forward(input_ids, labels, n_items)
+                        else:
+                            loss = forward_model(input_ids = input_ids, labels = labels, n_items = n_items).loss
+                        # loss = loss * inverse_gradient_accumulation_steps
+                        accumulated_loss += loss.detach()
+                    pass
+
+                    # Arm the in-backward hooks only for the final micro-batch
+                    # of the window, so accumulation still works
+                    if optimizer_in_backward is not None and i == n_batches - 1:
+                        optimizer_in_backward.arm()
+                    pass
+
+                    if float16_scaler is None:  loss.backward()
+                    else: float16_scaler.scale(loss).backward()
+                pass
 
-            if float16_scaler is None:
-                clip_grad_norm_(trainable_parameters, max_grad_norm)
-                optimizer.step()
-            else:
-                float16_scaler.unscale_(optimizer)
-                clip_grad_norm_(trainable_parameters, max_grad_norm)
-                float16_scaler.step(optimizer)
-                float16_scaler.update()
-            lr_scheduler.step()
-            optimizer.zero_grad()
-
-            if step % logging_steps == 0:
-                progress_bar.write(f"{step}, {round(accumulated_loss.cpu().item(), 4)}")
-            pass
-            accumulated_loss.zero_()
-            progress_bar.update(1)
+                # Materialize fp32 gradients again for clipping + the step
+                if bf16_gradient_accumulator is not None:
+                    bf16_gradient_accumulator.restore_gradients()
+                pass
+
+                # Never overlap a background checkpoint write with the next one
+                _wait_for_pending_checkpoints()
+
+                if optimizer_in_backward is not None:
+                    # Updates already ran inside backward; just advance the lr
+                    optimizer_in_backward.disarm()
+                    lr_scheduler.step()
+                    optimizer_in_backward.broadcast_lr()
+                elif cuda_graph_step is not None:
+                    # Clip + step + zero replay as one graph launch; gradients
+                    # are zeroed in place so their storage stays capture-valid
+                    cuda_graph_step.step()
+                    lr_scheduler.step()
+                    cuda_graph_step.sync_lr()
+                elif float16_scaler is None:
+                    clip_grad_norm_(trainable_parameters, max_grad_norm)
+                    optimizer.step()
+                    lr_scheduler.step()
+                    if use_graphed_forward:
+                        # Replay writes gradients into the captured storage -
+                        # zero in place instead of dropping the tensors
+                        torch._foreach_zero_([
+                            param.grad for param in trainable_parameters if param.grad is not None
+                        ])
+                    else:
+                        optimizer.zero_grad(set_to_none = True)
+                    pass
+                else:
+                    float16_scaler.unscale_(optimizer)
+                    clip_grad_norm_(trainable_parameters, max_grad_norm)
+                    float16_scaler.step(optimizer)
+                    float16_scaler.update()
+                    lr_scheduler.step()
+                    optimizer.zero_grad(set_to_none = True)
+                pass
 
-            step += 1
-            if step == max_steps: break
+                if step % logging_steps == 0:
+                    # Print the previous logging step's loss (its copy has long
+                    # finished), then enqueue this step's copy
+                    if pending_loss_step is not None:
+                        loss_copy_event.synchronize()
+                        progress_bar.write(f"{pending_loss_step}, {round(loss_cpu_buffer.item(), 4)}")
+                    pass
+                    loss_cpu_buffer.copy_(accumulated_loss, non_blocking = True)
+                    loss_copy_event.record()
+                    pending_loss_step = step
+                pass
+                accumulated_loss.zero_()
+                progress_bar.update(1)
+
+                step += 1
+                if save_steps != 0 and step % save_steps == 0:
+                    save_checkpoint(
+                        trainer,
+                        optimizer_in_backward if optimizer_in_backward is not None else optimizer,
+                        lr_scheduler, step, async_save = async_save,
+                    )
+                pass
+                if step >= max_steps: break
+                j += 1
+                if ga_ramp_start is None and j == max_iterations: break
+            pass
+            # The ramp's smaller early windows can reach max_steps mid-epoch -
+            # stop the epoch loop too, not just this epoch's window loop
+            if step >= max_steps: break
         pass
+    finally:
+        # Always detach the backward hooks, even on an exception -
+        # leaving them registered would null .grad into stale buffers
+        # on any later training pass over the same model
+        if bf16_gradient_accumulator is not None:
+            bf16_gradient_accumulator.detach()
+        if optimizer_in_backward is not None:
+            optimizer_in_backward.detach()
+        pass
+    pass
+    # Flush the last pending loss
+    if pending_loss_step is not None:
+        loss_copy_event.synchronize()
+        progress_bar.write(f"{pending_loss_step}, {round(loss_cpu_buffer.item(), 4)}")
     pass
+    _wait_for_pending_checkpoints()
     progress_bar.close()
     unset_training(model)
     logger.warning("Unsloth: Finished training!")